@@ -1,5 +1,6 @@
 import argparse
 import json
+from pathlib import Path
 from typing import Any, Dict
 
 from loguru import logger
@@ -16,19 +17,31 @@ def main(args: Dict[str, Any]) -> None:
     `args` : `Dict[str, Any]`
         Dictionary of CLI arguments passed to the script.
     """
-    client = UNDLClient(verbose=args["verbose"])
+    # Closing the client releases its HTTP connections
+    with UNDLClient(verbose=args["verbose"]) as client:
+        if args["id"]:
+            client.queryById(
+                recordId=args["id"],
+                outputFormat=args["format"],
+                outputFile=args["output"],
+            )
+        elif args["queries_file"]:
+            # All the queries share the same client, hence its HTTP session and
+            # caches
+            with open(args["queries_file"], "r") as f:
+                queries = [line.strip() for line in f if line.strip()]
 
-    if args["id"]:
-        client.queryById(
-            recordId=args["id"],
-            outputFormat=args["format"],
-            outputFile=args["output"],
-        )
-    else:
-        client.query(
-            prompt=args["query"],
-            outputFile=args["output"],
-        )
+            output = Path(args["output"])
+            for i, query in enumerate(queries):
+                client.query(
+                    prompt=query,
+                    outputFile=str(output.with_stem(f"{output.stem}_{i}")),
+                )
+        else:
+            client.query(
+                prompt=args["query"],
+                outputFile=args["output"],
+            )
 
 
 def parse_args() -> Dict[str, Any]:
@@ -49,6 +62,14 @@ def parse_args() -> Dict[str, Any]:
         "--query",
         help="Query string to search for.",
     )
+    parser.add_argument(
+        "--queries-file",
+        help=(
+            "File with one query string per line, to run them all in a single "
+            "process. Results are saved to the output file name suffixed with "
+            "the index of the query."
+        ),
+    )
     parser.add_argument(
         "--id",
         help="ID of the record to search for.",
@@ -85,5 +106,6 @@ def parse_args() -> Dict[str, Any]:
 
 if __name__ == "__main__":
     args = parse_args()
-    logger.debug(f"Args:\n{json.dumps(args, indent=2)}")
+    if args["verbose"]:
+        logger.debug(f"Args:\n{json.dumps(args, indent=2)}")
     main(args=args)
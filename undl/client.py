@@ -1,15 +1,94 @@
+import functools
+import hashlib
+import io
+import json
 import os
-import xml.etree.ElementTree as E
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlencode
 
 import pymarc
 import requests
 from loguru import logger
-from pymarc import Record
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import undl.consts as consts
 
+# orjson is optional: results are serialized by the standard library otherwise
+try:
+    import orjson
+
+    _HAS_ORJSON = True
+except ImportError:
+    _HAS_ORJSON = False
+
+# A MARC field: the data of a control field, or the (code, value) subfield
+# pairs of a data field
+MARCField = str | Tuple[Tuple[str, str], ...]
+
+# The fields of a record, by slot (see `consts.FIELD_SLOTS`). Slots of tags the
+# record does not have are `None`.
+IndexedFields = List[Optional[List[MARCField]]]
+
+# `consts.RECORD_SCHEMA`, with the tags resolved to their field index slot
+_RECORD_SCHEMA = tuple(
+    (key, consts.FIELD_SLOTS[tag], subfield, collection)
+    for key, tag, subfield, collection in consts.RECORD_SCHEMA
+)
+
+
+def _dumpJSON(data: Any) -> bytes:
+    """
+    Serialize parsed results to indented JSON, with `orjson` when it is
+    installed and the standard library otherwise.
+
+    Parameters
+    ----------
+    `data` : `Any`
+        The data to serialize.
+
+    Returns
+    -------
+    `bytes`
+        The UTF-8 encoded JSON document.
+    """
+    if _HAS_ORJSON:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+
+    # Same indentation as orjson's, so the output does not depend on it
+    return json.dumps(data, indent=2, ensure_ascii=False).encode("utf-8")
+
+
+def _loadJSON(content: bytes) -> Any:
+    """
+    Deserialize a JSON response, with `orjson` when it is installed and the
+    standard library otherwise.
+
+    Parameters
+    ----------
+    `content` : `bytes`
+        The JSON document.
+
+    Returns
+    -------
+    `Any`
+        The deserialized data.
+
+    Raises
+    ------
+    `ValueError`
+        If `content` is not valid JSON.
+    """
+    if _HAS_ORJSON:
+        return orjson.loads(content)
+
+    return json.loads(content)
+
 
 class UNDLClient:
     """
@@ -20,12 +99,92 @@ class UNDLClient:
     query_cache: Dict[str, Any]
     id_cache: Dict[str, Any]
     record_cache: Dict[str, Any]
+    session: requests.Session
+    use_cache: bool
+    cache_ttl: Optional[int]
+    cache_dir: Path
 
-    def __init__(self, verbose: bool = False):
+    def __init__(
+        self,
+        verbose: bool = False,
+        useCache: bool = True,
+        cacheTtl: Optional[int] = None,
+    ):
+        """
+        Parameters
+        ----------
+        `verbose` : `bool`, optional
+            Print verbose output, by default `False`
+        `useCache` : `bool`, optional
+            Cache the raw API responses on disk, so that identical requests
+            skip the network, by default `True`
+        `cacheTtl` : `Optional[int]`, optional
+            Number of seconds after which a cached response expires, by
+            default `None`: a day for searches, never for records
+        """
         self.verbose = verbose
         self.query_cache = {}
         self.id_cache = {}
         self.record_cache = {}
+        self.use_cache = useCache
+        self.cache_ttl = cacheTtl
+        self.cache_dir = consts.CACHE_DIR
+
+        # Created once here rather than on every cache write
+        if self.use_cache:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+            except OSError as e:
+                logger.warning(
+                    "Disabling the cache, {} is unusable: {}", self.cache_dir, e
+                )
+                self.use_cache = False
+
+        # A single session keeps the connection (and its TLS session) to the
+        # UNDL servers alive across queries
+        self.session = requests.Session()
+        self.session.headers["content-type"] = "application/xml"
+        self.session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=consts.POOL_CONNECTIONS,
+                pool_maxsize=consts.POOL_MAXSIZE,
+                max_retries=Retry(
+                    total=consts.MAX_RETRIES,
+                    backoff_factor=consts.RETRY_BACKOFF_FACTOR,
+                    status_forcelist=consts.RETRY_STATUS_CODES,
+                ),
+            ),
+        )
+
+    def close(self) -> None:
+        """
+        Release the HTTP connections of the client.
+        """
+        self.session.close()
+
+    def __enter__(self) -> "UNDLClient":
+        """
+        Use the client in a `with` block, which closes it on exit.
+
+        Returns
+        -------
+        `UNDLClient`
+            The client itself.
+        """
+        return self
+
+    def __exit__(self, *excInfo: Any) -> None:
+        """
+        Close the client when leaving its `with` block.
+
+        Parameters
+        ----------
+        `excInfo` : `Any`
+            Type, value and traceback of the exception raised in the block,
+            if any. They are not handled, so the exception propagates.
+        """
+        self.close()
 
     def query(
         self,
@@ -34,8 +193,8 @@ class UNDLClient:
         lang: str = "en",
         outputFile: Optional[str] = None,
         searchId: Optional[str] = None,
-        apiKey: Optional[str] = os.getenv("UN_API"),
-    ) -> Dict[str, Any] | str | None:
+        apiKey: Optional[str] = consts.API_KEY,
+    ) -> Dict[str, Any]:
         """
         Function to query the official UNDL API.
 
@@ -53,18 +212,25 @@ class UNDLClient:
             Search ID, by default `None`
         `apiKey` : `Optional[str]`, optional
             API key in the case we use the new URL, by default
-            `os.getenv("UN_API")`
+            `consts.API_KEY`
 
         Returns
         -------
-        `Dict[str, Any] | str | None`
+        `Dict[str, Any]`
             The query results
         """
         if prompt in self.query_cache:
-            logger.success(f"Found prompt '{prompt}' in cache.")
-            return self.query_cache[prompt]
+            logger.success("Found prompt '{}' in cache.", prompt)
+            result = self.query_cache[prompt]
 
-        logger.success(f"Querying official UNDL API for prompt '{prompt}'")
+            # The output file is written on every call, not only the first one
+            if outputFile:
+                with open(outputFile, "wb") as f:
+                    f.write(_dumpJSON(result))
+
+            return result
+
+        logger.success("Querying official UNDL API for prompt '{}'", prompt)
 
         params = {
             "p": prompt,
@@ -73,7 +239,7 @@ class UNDLClient:
         }
 
         if self.verbose:
-            logger.info(f"Querying UNDL API with params: {params}")
+            logger.info("Querying UNDL API with params: {}", params)
 
         result = self._query(
             params=params,
@@ -123,11 +289,18 @@ class UNDLClient:
         """
 
         if prompt in self.id_cache:
-            logger.success(f"Found prompt '{prompt}' in cache.")
-            return self.id_cache[prompt]
+            logger.success("Found prompt '{}' in cache.", prompt)
+            result = self.id_cache[prompt]
+
+            # The output file is written on every call, not only the first one
+            if outputFile:
+                with open(outputFile, "wb") as f:
+                    f.write(_dumpJSON(result))
+
+            return result
 
         logger.success(
-            f"Querying official UNDL API for record IDs of prompt '{prompt}'"
+            "Querying official UNDL API for record IDs of prompt '{}'", prompt
         )
         params = {
             "p": prompt,
@@ -135,7 +308,7 @@ class UNDLClient:
         }
 
         if self.verbose:
-            logger.info(f"Querying UNDL API with params: {params}")
+            logger.info("Querying UNDL API with params: {}", params)
 
         result = self._query(
             params=params,
@@ -150,8 +323,9 @@ class UNDLClient:
     def queryById(
         self,
         recordId: str,
+        outputFormat: str = consts.DEFAULT_FORMAT,
         outputFile: Optional[str] = None,
-    ) -> Dict[str, Any] | str | None:
+    ) -> Dict[str, Any]:
         """
         Function to query the API for a unique ID.
 
@@ -166,32 +340,49 @@ class UNDLClient:
         `oldURL` : `bool`, optional
             Flag to use the old URL instead of the official one, by default True
         `apiKey` : `Optional[str]`, optional
-            API key in the case we use the new URL, by default `os.getenv("UN_API")`
+            API key in the case we use the new URL, by default `consts.API_KEY`
 
         Returns
         -------
-        `Dict[str, Any] | str | None`
+        `Dict[str, Any]`
             The query results
         """
 
         if recordId in self.record_cache:
-            logger.success(f"Found record ID '{recordId}' in cache.")
-            return self.record_cache[recordId]
+            logger.success("Found record ID '{}' in cache.", recordId)
+            result = self.record_cache[recordId]
+
+            # The output file is written on every call, not only the first one
+            if outputFile:
+                with open(outputFile, "wb") as f:
+                    f.write(_dumpJSON(result))
+
+            return result
 
-        logger.info(f"Querying UNDL API for unique ID '{recordId}'")
+        logger.info("Querying UNDL API for unique ID '{}'", recordId)
+
+        apiFormat = consts.FORMATS.get(outputFormat)
+        if apiFormat is None:
+            logger.warning(
+                "Unknown format '{}', using '{}' instead.",
+                outputFormat,
+                consts.DEFAULT_FORMAT,
+            )
+            outputFormat = consts.DEFAULT_FORMAT
+            apiFormat = consts.FORMATS[outputFormat]
 
         params = {
             "recid": recordId,
-            "of": "xm",
+            "of": apiFormat,
             "c": "Resource Type",
         }
 
         if self.verbose:
-            logger.info(f"Querying UNDL API with params: {params}")
+            logger.info("Querying UNDL API with params: {}", params)
 
         result = self._queryUnofficial(
             params=params,
-            outputFormat="marcxml",
+            outputFormat=outputFormat,
             outputFile=outputFile,
         )
 
@@ -199,6 +390,65 @@ class UNDLClient:
 
         return result
 
+    def queryByIdBatch(
+        self,
+        recordIds: List[str],
+        outputFormat: str = consts.DEFAULT_FORMAT,
+        outputFile: Optional[str] = None,
+        maxWorkers: int = consts.POOL_MAXSIZE,
+    ) -> Dict[str, Any]:
+        """
+        Query the API for several unique IDs at once.
+
+        The requests are sent concurrently over the client's connection pool,
+        so fetching N records takes about as long as the slowest one instead
+        of the sum of all of them.
+
+        Parameters
+        ----------
+        `recordIds` : `List[str]`
+            The IDs to query for.
+        `outputFormat` : `str`, optional
+            Output format _from the API_, by default consts.DEFAULT_FORMAT
+        `outputFile` : `Optional[str]`, optional
+            File to which the script will save the query results, by default None
+        `maxWorkers` : `int`, optional
+            Maximum number of concurrent requests, by default
+            `consts.POOL_MAXSIZE`
+
+        Returns
+        -------
+        `Dict[str, Any]`
+            The records, in the same order as `recordIds`
+        """
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            results = list(
+                executor.map(
+                    lambda recordId: self.queryById(
+                        recordId=recordId,
+                        outputFormat=outputFormat,
+                    ),
+                    recordIds,
+                )
+            )
+
+        records = [record for result in results for record in result["records"]]
+        output = {
+            "total": len(records),
+            "search_id": None,
+            "records": records,
+        }
+
+        if outputFile:
+            with open(outputFile, "wb") as f:
+                f.write(_dumpJSON(output))
+
+        logger.success(
+            "Query successful. Saved {} result(s) to {}.", len(records), outputFile
+        )
+
+        return output
+
     """
     Helper functions
     """
@@ -208,9 +458,9 @@ class UNDLClient:
         params: Dict[str, Any],
         outputFormat: str = consts.DEFAULT_API_FORMAT,
         outputFile: Optional[str] = None,
-        apiKey: Optional[str] = os.getenv("UN_API"),
+        apiKey: Optional[str] = consts.API_KEY,
         searchId: Optional[str] = None,
-    ) -> List[Dict[str, Any]] | str | None:
+    ) -> Dict[str, Any]:
         """
         General query function.
 
@@ -223,75 +473,104 @@ class UNDLClient:
         `outputFile` : `Optional[str]`, optional
             File to which the output will be saved, by default None
         `apiKey` : `Optional[str]`, optional
-            The API key to use in the case of the new URL, by default None
+            The API key to use in the case of the new URL, by default
+            `consts.API_KEY`
 
         Returns
         -------
-        `List[Dict[str, Any]] | str | None`
+        `Dict[str, Any]`
             The query results
         """
 
         if searchId:
             params["search_id"] = searchId
 
-        r = requests.get(
+        content = self._fetch(
             consts.API_BASE_URL,
             params=params,
-            headers={
-                "content-type": "application/xml",
-                "Authorization": f"Token {apiKey}",
-            },
+            headers={"Authorization": f"Token {apiKey}"},
         )
 
-        logger.debug(f"URL: {r.url}")
-        logger.debug(f"Params: {params}")
+        if self.verbose:
+            logger.debug("Params: {}", params)
 
-        match outputFormat:
-            case "marcxml":
-                # Skip the namespace
-                responseXML = E.fromstring(
-                    r.text.replace('xmlns="http://www.loc.gov/MARC21/slim"', "")
-                )
+        handle = _HANDLERS.get(outputFormat)
+        if handle is None:
+            raise NotImplementedError("Only MARCXML is supported for now.")
+
+        return handle(self, content, outputFile=outputFile)
+
+    def _handleMARCXML(
+        self,
+        content: bytes,
+        outputFile: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Parse a MARCXML search response.
 
-                total = int(responseXML.find("total").text)
-                searchId = responseXML.find("search_id").text
+        Parameters
+        ----------
+        `content` : `bytes`
+            The raw API response.
+        `outputFile` : `Optional[str]`, optional
+            File to which the output will be saved, by default None
 
-                logger.info(f"Found {total} results.")
-                logger.debug(f"Search ID: {searchId}")
-                logger.debug(f"URL: {r.url}")
+        Returns
+        -------
+        `Dict[str, Any]`
+            The parsed search results.
+        """
+        # The whole response is streamed by parseMARCXML, which reads the
+        # total and search ID along the records. Elements are matched whatever
+        # their namespace, so the MARC21 one is kept.
+        parsedResponse = self.parseMARCXML(
+            xml=content,
+            outputFile=outputFile,
+        )
 
-                path = Path.home() / ".undl"
-                os.makedirs(path, exist_ok=True)
+        logger.info("Found {} results.", parsedResponse["total"])
+        if self.verbose:
+            logger.debug("Search ID: {}", parsedResponse["search_id"])
 
-                filePath = path / "tmp.xml"
-                with open(filePath, "w") as f:
-                    f.write(
-                        E.tostring(responseXML.find("collection"), encoding="unicode")
-                    )
+        logger.success(
+            "Query successful. Saved {} result(s) to {}.",
+            len(parsedResponse["records"]),
+            outputFile,
+        )
 
-                parsedResponse = self.parseMARCXML(
-                    xml=str(filePath),
-                    outputFile=outputFile,
-                    total=total,
-                    searchId=searchId,
-                )
-                logger.success(
-                    f"Query successful. Saved {len(parsedResponse['records'])} result(s) to {outputFile}."
-                )
-            case "json":
-                parsedResponse = r.json()
+        return parsedResponse
+
+    def _handleJSON(
+        self,
+        content: bytes,
+        outputFile: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Parse a JSON search response, listing the IDs of the matching records.
 
-                if outputFile:
-                    import json
+        Parameters
+        ----------
+        `content` : `bytes`
+            The raw API response.
+        `outputFile` : `Optional[str]`, optional
+            File to which the output will be saved, by default None
 
-                    with open(outputFile, "w") as f:
-                        json.dump(parsedResponse, f, indent=4, ensure_ascii=False)
+        Returns
+        -------
+        `Dict[str, Any]`
+            The parsed search results.
+        """
+        parsedResponse: Dict[str, Any] = _loadJSON(content)
 
-                logger.success(
-                    f"Query successful. Saved {len(parsedResponse['hits'])} result(s) to {outputFile}."
-                )
-            case _:
-                raise NotImplementedError("Only MARCXML is supported for now.")
+        if outputFile:
+            with open(outputFile, "wb") as f:
+                f.write(_dumpJSON(parsedResponse))
+
+        logger.success(
+            "Query successful. Saved {} result(s) to {}.",
+            len(parsedResponse["hits"]),
+            outputFile,
+        )
 
         return parsedResponse
 
@@ -300,7 +579,7 @@ class UNDLClient:
         params: Dict[str, Any],
         outputFormat: str = consts.DEFAULT_FORMAT,
         outputFile: Optional[str] = None,
-    ) -> List[Dict[str, Any]] | str | None:
+    ) -> Dict[str, Any]:
         """
         General query function.
 
@@ -317,128 +596,628 @@ class UNDLClient:
 
         Returns
         -------
-        `List[Dict[str, Any]] | str | None`
+        `Dict[str, Any]`
             The query results
         """
-        r = requests.get(
+        content = self._fetch(
             consts.BASE_URL,
             params=params,
         )
 
+        parse = _PARSERS.get(outputFormat)
+        if parse is None:
+            raise NotImplementedError(
+                "Only MARCXML and MARC-in-JSON are supported for now."
+            )
+
+        try:
+            parsedResponse = parse(self, content, outputFile=outputFile)
+        except ValueError:
+            # Only raised by the JSON parser: the API served another format
+            if outputFormat == consts.DEFAULT_FORMAT:
+                raise
+
+            logger.warning(
+                "The API did not return {}, falling back to {}.",
+                outputFormat,
+                consts.DEFAULT_FORMAT,
+            )
+            return self._queryUnofficial(
+                params={**params, "of": consts.FORMATS[consts.DEFAULT_FORMAT]},
+                outputFormat=consts.DEFAULT_FORMAT,
+                outputFile=outputFile,
+            )
+
+        logger.success(
+            "Query successful. Saved {} results to {}.", len(parsedResponse), outputFile
+        )
+
+        return parsedResponse
+
+    def _fetch(
+        self,
+        url: str,
+        params: Dict[str, Any],
+        headers: Optional[Dict[str, str]] = None,
+    ) -> bytes:
+        """
+        Fetch the raw response for a request, going through the on-disk cache
+        when it is enabled.
+
+        Parameters
+        ----------
+        `url` : `str`
+            URL to query.
+        `params` : `Dict[str, Any]`
+            Query parameters.
+        `headers` : `Optional[Dict[str, str]]`, optional
+            Headers to send along with the request, by default `None`
+
+        Returns
+        -------
+        `bytes`
+            The raw response body.
+        """
+        cachePath = self._cachePath(url, params)
+
+        if self.use_cache:
+            ttl = self.cache_ttl
+            if ttl is None:
+                ttl = consts.CACHE_TTLS.get(url)
+
+            cached = self._readCache(cachePath, ttl=ttl)
+            if cached is not None:
+                if self.verbose:
+                    logger.debug("Loaded cached response from {}", cachePath)
+                return cached
+
+        r = self.session.get(url, params=params, headers=headers)
+
         if self.verbose:
-            logger.debug(f"URL: {r.url}")
+            logger.debug("URL: {}", r.url)
+
+        # Error responses are not worth keeping around
+        if self.use_cache and r.ok:
+            self._writeCache(cachePath, r.content)
 
-        response = r.content.decode("utf-8")
+        return r.content
 
-        path = Path.home() / ".undl"
-        os.makedirs(path, exist_ok=True)
+    def _cachePath(self, url: str, params: Dict[str, Any]) -> Path:
+        """
+        Path under which the response to a request is cached.
 
-        filePath = path / "tmp.xml"
-        with open(filePath, "w") as f:
-            f.write(response)
+        Parameters
+        ----------
+        `url` : `str`
+            URL of the request.
+        `params` : `Dict[str, Any]`
+            Query parameters of the request.
 
-        match outputFormat:
-            case "marcxml":
-                parsedResponse = self.parseMARCXML(
-                    xml=str(filePath),
-                    outputFile=outputFile,
-                )
-            case _:
-                raise NotImplementedError("Only MARCXML is supported for now.")
+        Returns
+        -------
+        `Path`
+            The cache file path, named after a hash of the request.
+        """
+        request = f"{url}?{urlencode(sorted(params.items()))}"
+        key = hashlib.sha256(request.encode("utf-8")).hexdigest()
 
-        logger.success(
-            f"Query successful. Saved {len(parsedResponse)} results to {outputFile}."
-        )
+        return self.cache_dir / f"{key}.cache"
 
-        return parsedResponse
+    def _readCache(self, path: Path, ttl: Optional[int] = None) -> Optional[bytes]:
+        """
+        Read a cached response, if present and not expired.
+
+        Parameters
+        ----------
+        `path` : `Path`
+            Path of the cache file.
+        `ttl` : `Optional[int]`, optional
+            Number of seconds after which the response expires, by default
+            `None` (never)
+
+        Returns
+        -------
+        `Optional[bytes]`
+            The cached response, or `None` on a cache miss.
+        """
+        try:
+            if ttl is not None:
+                age = time.time() - path.stat().st_mtime
+                if age > ttl:
+                    return None
+
+            return path.read_bytes()
+        except OSError:
+            return None
+
+    def _writeCache(self, path: Path, content: bytes) -> None:
+        """
+        Atomically write a response to the cache, so that concurrent readers
+        never see a partially written file. Failures are logged and ignored.
+
+        Parameters
+        ----------
+        `path` : `Path`
+            Path of the cache file.
+        `content` : `bytes`
+            Response to cache.
+        """
+        tmpPath: Optional[str] = None
+
+        try:
+            # The file is closed, hence flushed, before being renamed
+            with tempfile.NamedTemporaryFile(
+                dir=self.cache_dir, suffix=".tmp", delete=False
+            ) as f:
+                tmpPath = f.name
+                f.write(content)
+
+            os.replace(tmpPath, path)
+        except OSError as e:
+            # The cache is only an optimization: never fail the query for it
+            logger.warning("Could not cache response to {}: {}", path, e)
+
+            if tmpPath is not None and os.path.exists(tmpPath):
+                os.unlink(tmpPath)
 
     def parseMARCXML(
         self,
-        xml: str,
+        xml: str | bytes | BinaryIO,
         outputFile: Optional[str] = None,
         total: Optional[int] = None,
         searchId: Optional[str] = None,
-    ) -> List[Dict[str, Any]]:
+        usePymarc: bool = False,
+    ) -> Dict[str, Any]:
         """
         Parse MARCXML to JSON.
 
         Parameters
         ----------
-        `xml` : `str`
-            MARCXML string to parse.
+        `xml` : `str | bytes | BinaryIO`
+            Path to, content of, or binary stream of the MARCXML to parse.
         `outputFile` : `Optional[str]`, optional
             File to which the output will be saved, by default `None`.
             In the `None` case, the output will be returned.
         `total` : `Optional[int]`, optional
-            Total number of results, by default `None`.
+            Total number of results, by default `None`: read from the
+            document when it is a search response.
         `searchId` : `Optional[str]`, optional
-            Search ID, by default `None`.
+            Search ID, by default `None`: read from the document when it is
+            a search response.
+        `usePymarc` : `bool`, optional
+            Read the records with pymarc rather than straight from lxml, by
+            default `False`. Much slower, this is only meant to check the
+            output of the default parser against.
 
         Returns
         -------
-        `List[Dict[str, Any]]`
-            The parsed MARCXML in a JSON-like format.
+        `Dict[str, Any]`
+            The parsed MARCXML in a JSON-like format: the `total`, `search_id`
+            and `records` of the document.
         """
-        output = {
+        output: Dict[str, Any] = {
             "total": total,
             "search_id": searchId,
             "records": [],
         }
-        records: List[Record] = pymarc.parse_xml_to_array(xml)
-
-        for record in records:
-            record = {
-                "id": self.extractFromMARC(record, "001"),
-                "title": self.extractFromMARC(record, "245"),
-                "alt_title": self.extractFromMARC(record, "239"),
-                "location": self.extractFromMARC(record, "260", "a"),
-                "symbol": self._getSymbol(record),
-                "publication_date": self.extractFromMARC(record, "269"),
-                "summary": self.extractFromMARC(record, "520"),
-                "authors": self.extractFromMARC(
-                    record,
-                    "710",
-                    "a",
-                    collection=True,
-                ),
-                "description": self.extractFromMARC(record, "300"),
-                "downloads": self._getDownloads(record),
-                "subjects": self._getSubjects(record),
-                "agenda": self.extractFromMARC(record, "991"),
-                "collections": self._getCollections(record),
-                "related_documents": self.extractFromMARC(
-                    record,
-                    "993",
-                    collection=True,
-                ),
-            }
 
-            # Remove empty fields
-            record = {k: v for k, v in record.items() if v}
+        indexedRecords: List[IndexedFields]
+
+        if usePymarc:
+            envelope, indexedRecords = self._pymarcRecords(xml)
+            records = [self._recordToDict(fields) for fields in indexedRecords]
+        else:
+            if isinstance(xml, bytes):
+                xml = io.BytesIO(xml)
 
-            output["records"].append(record)
+            envelope, indexedRecords = self._iterparseRecords(xml)
+            records = [self._recordToDict(fields) for fields in indexedRecords]
+
+        # Search responses carry their total and search ID along the records
+        if output["total"] is None and (envelopeTotal := envelope.get("total")):
+            output["total"] = int(envelopeTotal)
+        if output["search_id"] is None:
+            output["search_id"] = envelope.get("search_id")
+
+        output["records"] = records
 
         if outputFile:
-            import json
+            with open(outputFile, "wb") as f:
+                f.write(_dumpJSON(output))
+
+        return output
+
+    def _iterparseRecords(
+        self,
+        xml: str | BinaryIO,
+    ) -> Tuple[Dict[str, Optional[str]], List[IndexedFields]]:
+        """
+        Stream the records out of a MARCXML document and index them.
+
+        Parameters
+        ----------
+        `xml` : `str | BinaryIO`
+            Path to, or binary stream of, the MARCXML to parse.
+
+        Returns
+        -------
+        `Tuple[Dict[str, Optional[str]], List[IndexedFields]]`
+            The `total` and `search_id` of the document when it is a search
+            response, and the indexed fields of each record.
+        """
+        envelope: Dict[str, Optional[str]] = {}
+
+        # Records are indexed as soon as the parser emits them, and their
+        # elements are freed right after, so the full document tree is never
+        # held in memory. The indentation between elements and comments are
+        # dropped by libxml2 itself, so no Python string is ever created for
+        # them. huge_tree lifts the libxml2 size limits large pages can hit.
+        indexedRecords = []
+        for _, element in etree.iterparse(
+            xml,
+            events=("end",),
+            tag=("{*}record", "{*}total", "{*}search_id"),
+            huge_tree=True,
+            remove_blank_text=True,
+            remove_comments=True,
+        ):
+            localName = etree.QName(element).localname
+            if localName != "record":
+                envelope[localName] = element.text
+                continue
+
+            indexedRecords.append(self._indexFields(element))
+
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+        return envelope, indexedRecords
+
+    def _pymarcRecords(
+        self,
+        xml: str | bytes | BinaryIO,
+    ) -> Tuple[Dict[str, Optional[str]], List[IndexedFields]]:
+        """
+        Read the records of a MARCXML document with pymarc, and index them.
+
+        Parameters
+        ----------
+        `xml` : `str | bytes | BinaryIO`
+            Path to, content of, or binary stream of the MARCXML to parse.
+
+        Returns
+        -------
+        `Tuple[Dict[str, Optional[str]], List[IndexedFields]]`
+            The `total` and `search_id` of the document when it is a search
+            response, and the indexed fields of each record.
+        """
+        # The document is read twice: pymarc skips the search response
+        # envelope, which is read separately
+        if isinstance(xml, str):
+            content = Path(xml).read_bytes()
+        elif isinstance(xml, bytes):
+            content = xml
+        else:
+            content = xml.read()
+
+        envelope = {
+            etree.QName(element).localname: element.text
+            for _, element in etree.iterparse(
+                io.BytesIO(content),
+                events=("end",),
+                tag=("{*}total", "{*}search_id"),
+                huge_tree=True,
+            )
+        }
+
+        indexedRecords = [
+            self._indexPymarcFields(record)
+            for record in pymarc.parse_xml_to_array(io.BytesIO(content))
+            if record is not None
+        ]
+
+        return envelope, indexedRecords
+
+    def _parseMARCJSON(
+        self,
+        content: bytes,
+        outputFile: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Parse MARC-in-JSON to the same JSON format as `parseMARCXML`.
+
+        Parameters
+        ----------
+        `content` : `bytes`
+            MARC-in-JSON document, holding either a single record or a list of
+            records.
+        `outputFile` : `Optional[str]`, optional
+            File to which the output will be saved, by default `None`.
+
+        Returns
+        -------
+        `Dict[str, Any]`
+            The parsed records in a JSON-like format.
+
+        Raises
+        ------
+        `ValueError`
+            If `content` is not a MARC-in-JSON document.
+        """
+        records = _loadJSON(content)
 
-            with open(outputFile, "w") as f:
-                json.dump(output, f, indent=4, ensure_ascii=False)
+        if isinstance(records, dict):
+            records = [records]
+
+        if not isinstance(records, list) or not all(
+            isinstance(record, dict) and "fields" in record for record in records
+        ):
+            raise ValueError("Not a MARC-in-JSON document.")
+
+        output = {
+            "total": None,
+            "search_id": None,
+            "records": [
+                self._recordToDict(self._indexJSONFields(record)) for record in records
+            ],
+        }
+
+        if outputFile:
+            with open(outputFile, "wb") as f:
+                f.write(_dumpJSON(output))
 
         return output
 
-    def _getSubjects(self, record: Record) -> Dict[str, Any]:
+    def _recordToDict(self, fields: IndexedFields) -> Dict[str, Any]:
+        """
+        Convert a single MARC record to its JSON-like representation.
+
+        Parameters
+        ----------
+        `fields` : `IndexedFields`
+            Indexed fields of the record to convert.
+
+        Returns
+        -------
+        `Dict[str, Any]`
+            The record, without its empty fields.
+        """
+        result: Dict[str, Any] = {}
+
+        # Empty fields are skipped as they are extracted
+        for key, slot, subfield, collection in _RECORD_SCHEMA:
+            if value := self.extractFromMARC(fields, slot, subfield, collection):
+                result[key] = value
+
+        if symbol := self._getSymbol(fields):
+            result["symbol"] = symbol
+
+        if downloads := self._getDownloads(fields):
+            result["downloads"] = downloads
+
+        if subjects := self._getSubjects(fields):
+            result["subjects"] = subjects
+
+        if collections := self._getCollections(fields):
+            result["collections"] = collections
+
+        return result
+
+    def _indexFields(self, record: etree._Element) -> IndexedFields:
+        """
+        Group the fields of a MARCXML record by tag, so that each lookup done
+        while converting the record is a list access rather than a scan of
+        the whole field list.
+
+        Only the tags listed in `consts.FIELD_SLOTS` are indexed, the other
+        fields are skipped without reading their subfields. Control fields are
+        kept as their data string, and data fields as their `(code, value)`
+        subfield pairs.
+
+        Parameters
+        ----------
+        `record` : `etree._Element`
+            MARCXML `<record>` element to index.
+
+        Returns
+        -------
+        `IndexedFields`
+            The record fields, by slot.
+        """
+        fields: IndexedFields = [None] * consts.NB_FIELD_SLOTS
+
+        for element in record:
+            # The leader has no tag
+            slot = consts.FIELD_SLOTS.get(element.get("tag"))
+            if slot is None:
+                continue
+
+            field: MARCField
+            if element.tag.endswith("controlfield"):
+                field = element.text or ""
+            else:
+                field = tuple(
+                    (subfield.get("code"), subfield.text or "") for subfield in element
+                )
+
+            matches = fields[slot]
+            if matches is None:
+                fields[slot] = [field]
+            else:
+                matches.append(field)
+
+        return fields
+
+    def _indexJSONFields(self, record: Dict[str, Any]) -> IndexedFields:
+        """
+        Same as `_indexFields`, for a MARC-in-JSON record.
+
+        Parameters
+        ----------
+        `record` : `Dict[str, Any]`
+            MARC-in-JSON record to index.
+
+        Returns
+        -------
+        `IndexedFields`
+            The record fields, by slot.
+        """
+        fields: IndexedFields = [None] * consts.NB_FIELD_SLOTS
+
+        for entry in record["fields"]:
+            for tag, value in entry.items():
+                slot = consts.FIELD_SLOTS.get(tag)
+                if slot is None:
+                    continue
+
+                field: MARCField
+                if isinstance(value, str):
+                    field = value
+                else:
+                    field = tuple(
+                        (code, subfieldValue)
+                        for subfield in value.get("subfields", [])
+                        for code, subfieldValue in subfield.items()
+                    )
+
+                matches = fields[slot]
+                if matches is None:
+                    fields[slot] = [field]
+                else:
+                    matches.append(field)
+
+        return fields
+
+    def _indexPymarcFields(self, record: pymarc.Record) -> IndexedFields:
+        """
+        Group the fields of a pymarc record by tag, like `_indexFields`.
+
+        Parameters
+        ----------
+        `record` : `pymarc.Record`
+            Record to index.
+
+        Returns
+        -------
+        `IndexedFields`
+            The record fields, by slot.
+        """
+        fields: IndexedFields = [None] * consts.NB_FIELD_SLOTS
+
+        for pymarcField in record.fields:
+            slot = consts.FIELD_SLOTS.get(pymarcField.tag)
+            if slot is None:
+                continue
+
+            field: MARCField
+            if pymarcField.is_control_field():
+                field = pymarcField.data or ""
+            else:
+                # Subfields are a flat code, value, code, value... list
+                subfields = pymarcField.subfields
+                field = tuple(zip(subfields[::2], subfields[1::2]))
+
+            matches = fields[slot]
+            if matches is None:
+                fields[slot] = [field]
+            else:
+                matches.append(field)
+
+        return fields
+
+    def _subfield(self, field: MARCField, code: str) -> Optional[str]:
+        """
+        Get the first value of a subfield, like pymarc's `Field.__getitem__`.
+
+        Parameters
+        ----------
+        `field` : `MARCField`
+            Field from which to get the subfield.
+        `code` : `str`
+            Code of the subfield.
+
+        Returns
+        -------
+        `Optional[str]`
+            The subfield value, or `None` if the field does not have it.
+        """
+        if isinstance(field, str):
+            return None
+
+        for subfieldCode, value in field:
+            if subfieldCode == code:
+                return value
+
+        return None
+
+    @staticmethod
+    @functools.lru_cache(maxsize=consts.SUBFIELDS_CACHE_SIZE)
+    def _subfieldsAsDict(field: MARCField) -> Dict[str, List[str]]:
+        """
+        Map the subfield codes of a field to their values, like pymarc's
+        `Field.subfields_as_dict`.
+
+        Fields are plain tuples, so identical fields (the same subject or UN
+        body across the records of a page, typically) are only decomposed
+        once. The returned dictionary is shared and must not be modified.
+        The method is static so that the cache, keyed on the field alone,
+        does not keep the client alive.
+
+        Parameters
+        ----------
+        `field` : `MARCField`
+            Field to decompose.
+
+        Returns
+        -------
+        `Dict[str, List[str]]`
+            The subfield values, by code.
+        """
+        subfields: Dict[str, List[str]] = {}
+
+        if isinstance(field, str):
+            return subfields
+
+        for code, value in field:
+            subfields.setdefault(code, []).append(value)
+
+        return subfields
+
+    def _formatField(self, field: MARCField) -> str:
+        """
+        Format a field as a string, like pymarc's `Field.format_field`.
+
+        Parameters
+        ----------
+        `field` : `MARCField`
+            Field to format.
+
+        Returns
+        -------
+        `str`
+            The control field data, or the data field subfield values
+            separated by spaces.
+        """
+        if isinstance(field, str):
+            return field
+
+        # Subfield 6 only links to alternate graphic representations
+        return " ".join(value for code, value in field if code != "6").strip()
+
+    def _getSubjects(self, fields: IndexedFields) -> Dict[str, Any]:
         """
         Helper function to extract subject out of a MARCXML record.
 
         Parameters
         ----------
-        `record` : `Record`
-            MARCXML record from which to extract the subjects.
+        `fields` : `IndexedFields`
+            Indexed fields of the record from which to extract the subjects.
 
         Returns
         -------
         `Dict[str, Any]`
-            The subjects
+            The non-empty subject lists, among `unbist`, `unbisn` and `misc`
         """
         subjects: Dict[str, List[str]] = {
             "unbist": [],
@@ -446,84 +1225,88 @@ class UNDLClient:
             "misc": [],
         }
 
-        raw_subjects = record.subjects()
-
-        for raw_subject in raw_subjects:
-            subject = raw_subject.subfields_as_dict()
-            if subject["2"] == ["unbist"]:
-                subjects["unbist"].extend(subject["a"])
-            elif subject["2"] == ["unbisn"]:
-                subjects["unbisn"].extend(subject["a"])
+        for raw_subject in fields[consts.SUBJECTS_SLOT] or ():
+            subject = self._subfieldsAsDict(raw_subject)
+            if subject.get("2") == ["unbist"]:
+                subjects["unbist"].extend(subject.get("a", []))
+            elif subject.get("2") == ["unbisn"]:
+                subjects["unbisn"].extend(subject.get("a", []))
             else:
-                subjects["misc"].extend(subject["a"])
+                subjects["misc"].extend(subject.get("a", []))
 
-        return subjects
+        # Empty buckets are dropped, so that a record without subjects gets
+        # an empty dictionary and no "subjects" entry at all
+        return {k: v for k, v in subjects.items() if v}
 
-    def _getDownloads(self, record: Record) -> Dict[str, Any]:
+    def _getDownloads(self, fields: IndexedFields) -> Dict[str, Any]:
         """
         Helper function to extract downloads out of a MARCXML record.
 
         Parameters
         ----------
-        `record` : `Record`
-            MARCXML record from which to extract the downloads.
+        `fields` : `IndexedFields`
+            Indexed fields of the record from which to extract the downloads.
 
         Returns
         -------
         `Dict[str, Any]`
             The downloads
         """
-        links: Dict[str, Any] = self.extractFromMARC(
-            record,
-            "856",
-            "u",
-            collection=True,
-        )
+        downloads: Dict[str, Any] = {}
 
-        langs = self.extractFromMARC(
-            record,
-            "856",
-            "y",
-            collection=True,
-        )
+        # Each 856 field describes one file: its link ($u) is paired with the
+        # label ($y) of the same field. These fields are unique to the record,
+        # so they are not worth going through the memoized decomposition.
+        for field in fields[consts.DOWNLOADS_SLOT] or ():
+            lang = self._subfield(field, "y")
+            link = self._subfield(field, "u")
+            if lang is not None and link is not None:
+                downloads[lang] = link
 
-        return {lang: link for lang, link in zip(langs, links)}
+        return downloads
 
-    def _getCollections(self, record: Record) -> Dict[str, Any]:
+    def _getCollections(self, fields: IndexedFields) -> Dict[str, Any]:
         """
         Get collections from the MARCXML record.
         See https://research.un.org/en/digitallibrary/export
 
         Parameters
         ----------
-        `record` : `Dict[str, Any]`
-            MARCXML record from which to extract the collections.
+        `fields` : `IndexedFields`
+            Indexed fields of the record from which to extract the collections.
 
         Returns
         -------
         `Dict[str, Any]`
-            The collections
+            The non-empty collection lists, among `resource_type` and
+            `un_bodies`
         """
 
-        resource_type = record["989"].subfields_as_dict() if "989" in record else {}
-        un_bodies = record["981"].subfields_as_dict() if "981" in record else {}
+        resourceTypes = fields[consts.RESOURCE_TYPES_SLOT]
+        unBodies = fields[consts.UN_BODIES_SLOT]
 
-        collections = {
-            "resource_type": [v[0] for v in resource_type.values()],
-            "un_bodies": [v[0] for v in un_bodies.values()],
-        }
+        resource_type = self._subfieldsAsDict(resourceTypes[0]) if resourceTypes else {}
+        un_bodies = self._subfieldsAsDict(unBodies[0]) if unBodies else {}
+
+        collections = {}
+
+        if resource_type:
+            collections["resource_type"] = [v[0] for v in resource_type.values()]
+        if un_bodies:
+            collections["un_bodies"] = [v[0] for v in un_bodies.values()]
 
         return collections
 
-    def _getSymbol(self, record: Record) -> Optional[str | Dict[str, Any]]:
+    def _getSymbol(self, fields: IndexedFields) -> Optional[str | List[str]]:
         """
         Get document symbol from the MARCXML record.
         See https://research.un.org/en/digitallibrary/export
 
         Parameters
         ----------
-        `record` : `Dict[str, Any]`
-            MARCXML record from which to extract the document symbol.
+        `fields` : `IndexedFields`
+            Indexed fields of the record from which to extract the document
+            symbol.
 
         Returns
         -------
@@ -531,50 +1314,79 @@ class UNDLClient:
             The document symbol
         """
 
-        symbol = self.extractFromMARC(record, "191", "a")
+        symbol = self.extractFromMARC(fields, consts.SYMBOL_SLOT, "a")
 
         if not symbol:
-            symbol = self.extractFromMARC(record, "791", "a")
+            symbol = self.extractFromMARC(fields, consts.ALT_SYMBOL_SLOT, "a")
 
         return symbol
 
     def extractFromMARC(
         self,
-        record: Record,
-        field: str,
+        fields: IndexedFields,
+        field: int,
         subfield: Optional[str] = None,
         collection: bool = False,
-    ) -> Optional[str | Dict[str, Any]]:
+    ) -> Optional[str | List[str]]:
         """
         Extract a field from a MARC record.
 
         Parameters
         ----------
-        `record` : `Dict[str, Any]`
-            MARCXML record from which to extract the field.
-        `field` : `str`
-            MARC field to extract.
+        `fields` : `IndexedFields`
+            Indexed fields of the MARC record, as returned by `_indexFields`.
+        `field` : `int`
+            Slot of the MARC field to extract, see `consts.FIELD_SLOTS`.
         `subfield` : `str`, optional
             MARC subfield to extract. None by default.
+        `collection` : `bool`, optional
+            Whether to return all the matching values instead of the first
+            one, by default `False`.
 
         Returns
         -------
-        `Optional[str | Dict[str, Any]]`
+        `Optional[str | List[str]]`
             The extracted field.
         """
-        try:
-            result = list(
-                map(
-                    lambda x: x[subfield] if subfield else x.format_field(),
-                    record.get_fields(field),
-                )
-            )
+        matches = fields[field]
 
-            if not collection and result:
-                result = result[0]
-            return result
+        if not matches:
+            return None
+
+        if not collection:
+            # Only the first value is wanted: stop at it rather than
+            # extracting them all
+            if not subfield:
+                return self._formatField(matches[0])
+
+            # Fields lacking the subfield are skipped
+            for f in matches:
+                value = self._subfield(f, subfield)
+                if value is not None:
+                    return value
 
-        except Exception as e:
-            if self.verbose:
-                logger.error(f"Could not extract field {field} from MARC record. {e}")
             return None
+
+        if subfield:
+            return [
+                value
+                for f in matches
+                if (value := self._subfield(f, subfield)) is not None
+            ]
+
+        return [self._formatField(f) for f in matches]
+
+
+# Parsers of the formats supported by `UNDLClient.queryById`, taking the raw
+# API response
+_PARSERS: Dict[str, Callable[..., Dict[str, Any]]] = {
+    "marcxml": UNDLClient.parseMARCXML,
+    "marcjson": UNDLClient._parseMARCJSON,
+}
+
+# Handlers of the formats supported by `UNDLClient._query`, taking the raw API
+# response
+_HANDLERS: Dict[str, Callable[..., Dict[str, Any]]] = {
+    "marcxml": UNDLClient._handleMARCXML,
+    "json": UNDLClient._handleJSON,
+}
@@ -1,14 +1,35 @@
 import os
+from pathlib import Path
 
 API_BASE_URL = "https://digitallibrary.un.org/api/v1/search"
 BASE_URL = "https://digitallibrary.un.org/search"
 
 MAX_NB_RESULTS = 200
 
+SUBFIELDS_CACHE_SIZE = 4096
+
+CACHE_DIR = Path.home() / ".cache" / "undl"
+
+# Number of seconds after which a cached response expires, by endpoint. Search
+# results change as documents are added to the library, whereas a record,
+# fetched by its ID, is effectively immutable (`None`: never expires)
+CACHE_TTLS = {
+    API_BASE_URL: 24 * 60 * 60,
+    BASE_URL: None,
+}
+
+# Both endpoints are served by the same host, so one connection pool is enough
+POOL_CONNECTIONS = 1
+POOL_MAXSIZE = 16
+MAX_RETRIES = 3
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
 FORMATS = {
     "bibtex": "btex",
     "marc": "hm",
     "marcxml": "xm",
+    "marcjson": "xj",
     "dublincore": "xd",
     "endnote": "xe",
     "nlm": "xn",
@@ -16,6 +37,82 @@ FORMATS = {
     "ris": "ris",
 }
 
+# Plain fields extracted from each MARC record, as
+# (output key, MARC tag, MARC subfield, collection)
+RECORD_SCHEMA = (
+    ("id", "001", None, False),
+    ("title", "245", None, False),
+    ("alt_title", "239", None, False),
+    ("location", "260", "a", False),
+    ("publication_date", "269", None, False),
+    ("summary", "520", None, False),
+    ("authors", "710", "a", True),
+    ("description", "300", None, False),
+    ("agenda", "991", None, False),
+    ("related_documents", "993", None, True),
+)
+
+# Tags considered as subject fields by `pymarc.Record.subjects()`
+SUBJECT_TAGS = (
+    "600",
+    "610",
+    "611",
+    "630",
+    "648",
+    "650",
+    "651",
+    "653",
+    "654",
+    "655",
+    "656",
+    "657",
+    "658",
+    "662",
+    "690",
+    "691",
+    "696",
+    "697",
+    "698",
+    "699",
+)
+
+# Tags read from the MARC records, each with its own slot in the field index.
+# Fields with any other tag are skipped while parsing.
+INDEXED_TAGS = (
+    "001",
+    "191",
+    "239",
+    "245",
+    "260",
+    "269",
+    "300",
+    "520",
+    "710",
+    "791",
+    "856",
+    "981",
+    "989",
+    "991",
+    "993",
+)
+
+# All the subject fields share the last slot, in record order
+SUBJECTS_SLOT = len(INDEXED_TAGS)
+NB_FIELD_SLOTS = SUBJECTS_SLOT + 1
+
+FIELD_SLOTS = {
+    **{tag: slot for slot, tag in enumerate(INDEXED_TAGS)},
+    **{tag: SUBJECTS_SLOT for tag in SUBJECT_TAGS},
+}
+
+# Slots of the fields read by the dedicated helpers of the client, resolved
+# once rather than on every record
+SYMBOL_SLOT = FIELD_SLOTS["191"]
+ALT_SYMBOL_SLOT = FIELD_SLOTS["791"]
+DOWNLOADS_SLOT = FIELD_SLOTS["856"]
+UN_BODIES_SLOT = FIELD_SLOTS["981"]
+RESOURCE_TYPES_SLOT = FIELD_SLOTS["989"]
+
 DEFAULT_API_FORMAT = "xml"
 DEFAULT_FORMAT = "marcxml"
 
@@ -8,17 +8,153 @@ Created on Wed May 10 18:23:43 2023
 """
 
 import json
+import os
+import time
+from pathlib import Path
+from typing import Any, List
+from unittest import mock
 
+import requests
 from loguru import logger
 
+import undl.consts as consts
 from undl.client import UNDLClient
 
+# A search response trimmed to two records, to test the parsers offline
+SEARCH_RESPONSE = b"""<?xml version="1.0" encoding="UTF-8"?>
+<response>
+  <total>120</total>
+  <search_id>SID</search_id>
+  <collection xmlns="http://www.loc.gov/MARC21/slim">
+    <record>
+      <controlfield tag="001">515307</controlfield>
+      <datafield tag="191" ind1=" " ind2=" ">
+        <subfield code="a">A/RES/70/1</subfield>
+      </datafield>
+      <datafield tag="245" ind1="1" ind2="0">
+        <subfield code="a">Transforming our world :</subfield>
+        <subfield code="b">the 2030 Agenda</subfield>
+      </datafield>
+      <datafield tag="269" ind1=" " ind2=" ">
+        <subfield code="a">2015-10-21</subfield>
+      </datafield>
+      <datafield tag="650" ind1="1" ind2="7">
+        <subfield code="a">SUSTAINABLE DEVELOPMENT</subfield>
+        <subfield code="2">unbist</subfield>
+      </datafield>
+      <datafield tag="710" ind1="2" ind2=" ">
+        <subfield code="a">UN. General Assembly</subfield>
+      </datafield>
+      <datafield tag="856" ind1="4" ind2=" ">
+        <subfield code="u">https://digitallibrary.un.org/record/515307/files/A_RES_70_1-EN.pdf</subfield>
+        <subfield code="y">English</subfield>
+      </datafield>
+      <datafield tag="989" ind1=" " ind2=" ">
+        <subfield code="a">Documents and Publications</subfield>
+        <subfield code="b">Resolutions and Decisions</subfield>
+      </datafield>
+    </record>
+    <record>
+      <controlfield tag="001">1000</controlfield>
+      <datafield tag="245" ind1="1" ind2="0">
+        <subfield code="a">Women in peacekeeping</subfield>
+      </datafield>
+      <datafield tag="791" ind1=" " ind2=" ">
+        <subfield code="a">S/2000/1</subfield>
+      </datafield>
+      <datafield tag="981" ind1=" " ind2=" ">
+        <subfield code="a">Security Council</subfield>
+      </datafield>
+    </record>
+  </collection>
+</response>
+"""
+
+# The first record of SEARCH_RESPONSE, as served in MARC-in-JSON
+RECORD_MARCJSON = json.dumps(
+    {
+        "leader": "00000nam a2200000 a 4500",
+        "fields": [
+            {"001": "515307"},
+            {"191": {"ind1": " ", "ind2": " ", "subfields": [{"a": "A/RES/70/1"}]}},
+            {
+                "245": {
+                    "ind1": "1",
+                    "ind2": "0",
+                    "subfields": [
+                        {"a": "Transforming our world :"},
+                        {"b": "the 2030 Agenda"},
+                    ],
+                }
+            },
+            {"269": {"ind1": " ", "ind2": " ", "subfields": [{"a": "2015-10-21"}]}},
+            {
+                "650": {
+                    "ind1": "1",
+                    "ind2": "7",
+                    "subfields": [{"a": "SUSTAINABLE DEVELOPMENT"}, {"2": "unbist"}],
+                }
+            },
+            {
+                "710": {
+                    "ind1": "2",
+                    "ind2": " ",
+                    "subfields": [{"a": "UN. General Assembly"}],
+                }
+            },
+            {
+                "856": {
+                    "ind1": "4",
+                    "ind2": " ",
+                    "subfields": [
+                        {
+                            "u": "https://digitallibrary.un.org/record/515307/files/"
+                            "A_RES_70_1-EN.pdf"
+                        },
+                        {"y": "English"},
+                    ],
+                }
+            },
+            {
+                "989": {
+                    "ind1": " ",
+                    "ind2": " ",
+                    "subfields": [
+                        {"a": "Documents and Publications"},
+                        {"b": "Resolutions and Decisions"},
+                    ],
+                }
+            },
+        ],
+    }
+).encode("utf-8")
+
+
+def _fakeResponse(content: bytes, statusCode: int = 200) -> requests.Response:
+    """
+    Build a response as returned by `requests`, without any network access.
+    """
+    response = requests.Response()
+    response.status_code = statusCode
+    response._content = content
+    response.url = consts.BASE_URL
+
+    return response
+
+
+def _cachedClient(cacheDir: Path, **kwargs: Any) -> UNDLClient:
+    """
+    Build a client whose on-disk cache lives in `cacheDir`.
+    """
+    with mock.patch.object(consts, "CACHE_DIR", cacheDir):
+        return UNDLClient(**kwargs)
+
 
 def testQuery() -> None:
     """
     Test the query function.
     """
-    client = UNDLClient(verbose=True)
+    client = UNDLClient(verbose=True, useCache=False)
     outputFile = "downloads/test.json"
     client.query(
         prompt="Women in peacekeeping",
@@ -35,7 +171,7 @@ def testGetIds() -> None:
     """
     Test the getAllRecordIds function.
     """
-    client = UNDLClient(verbose=True)
+    client = UNDLClient(verbose=True, useCache=False)
     outputFile = "downloads/test_record_ids.json"
     client.getAllRecordIds(
         prompt="Women in peacekeeping",
@@ -52,7 +188,7 @@ def testById() -> None:
     """
     Test the queryById function.
     """
-    client = UNDLClient(verbose=True)
+    client = UNDLClient(verbose=True, useCache=False)
     outputFile = "downloads/test_by_id.json"
     client.queryById(
         recordId="515307",
@@ -67,6 +203,223 @@ def testById() -> None:
     assert len(data["records"]) == 1
 
 
+def testByIdMARCJSON() -> None:
+    """
+    Test the queryById function with the MARC-in-JSON format.
+    """
+    client = UNDLClient(useCache=False)
+
+    # The client silently falls back to MARCXML when it cannot parse the
+    # response, which would make this test pass regardless
+    warnings: List[Any] = []
+    sinkId = logger.add(warnings.append, level="WARNING")
+    try:
+        with mock.patch.object(
+            client.session, "get", return_value=_fakeResponse(RECORD_MARCJSON)
+        ) as get:
+            parsed = client.queryById(recordId="515307", outputFormat="marcjson")
+    finally:
+        logger.remove(sinkId)
+
+    assert not warnings
+    assert get.call_args.kwargs["params"]["of"] == consts.FORMATS["marcjson"]
+    assert parsed["records"] == client.parseMARCXML(SEARCH_RESPONSE)["records"][:1]
+
+
+def testByIdMARCJSONFallback() -> None:
+    """
+    Test that queryById falls back to MARCXML when the API does not serve
+    MARC-in-JSON.
+    """
+    client = UNDLClient(useCache=False)
+
+    warnings: List[Any] = []
+    sinkId = logger.add(warnings.append, level="WARNING")
+    try:
+        # The API answers with MARCXML whatever the requested format
+        with mock.patch.object(
+            client.session, "get", return_value=_fakeResponse(SEARCH_RESPONSE)
+        ) as get:
+            parsed = client.queryById(recordId="515307", outputFormat="marcjson")
+    finally:
+        logger.remove(sinkId)
+
+    assert len(warnings) == 1
+    assert [call.kwargs["params"]["of"] for call in get.call_args_list] == [
+        consts.FORMATS["marcjson"],
+        consts.FORMATS["marcxml"],
+    ]
+    assert parsed == client.parseMARCXML(SEARCH_RESPONSE)
+
+
+def testByIdBatch() -> None:
+    """
+    Test the queryByIdBatch function.
+    """
+    client = UNDLClient(verbose=True, useCache=False)
+    outputFile = "downloads/test_by_id_batch.json"
+    hits = client.getAllRecordIds(prompt="Women in peacekeeping")["hits"]
+    recordIds = [str(hit) for hit in hits[:3]]
+    client.queryByIdBatch(
+        recordIds=recordIds,
+        outputFile=outputFile,
+    )
+
+    with open(outputFile, "r") as f:
+        data = json.load(f)
+
+    assert [record["id"] for record in data["records"]] == recordIds
+
+
+def testParseMARCXMLPymarc() -> None:
+    """
+    Test that the pymarc fallback of parseMARCXML gives the same output as
+    the default parser.
+    """
+    client = UNDLClient(useCache=False)
+
+    parsed = client.parseMARCXML(SEARCH_RESPONSE)
+
+    assert parsed["total"] == 120
+    assert parsed["search_id"] == "SID"
+    assert [record["id"] for record in parsed["records"]] == ["515307", "1000"]
+    assert parsed == client.parseMARCXML(SEARCH_RESPONSE, usePymarc=True)
+
+
+def testContextManager() -> None:
+    """
+    Test that leaving a `with` block closes the client.
+    """
+    client = UNDLClient(useCache=False)
+
+    with mock.patch.object(client.session, "close") as close:
+        with client as entered:
+            assert entered is client
+            close.assert_not_called()
+
+        close.assert_called_once_with()
+
+
+def testQueryCachedOutputFile(tmp_path: Path) -> None:
+    """
+    Test that a query served from the in-memory cache still writes its
+    output file.
+    """
+    client = UNDLClient(useCache=False)
+    client.query_cache["Women in peacekeeping"] = client.parseMARCXML(SEARCH_RESPONSE)
+    outputFile = tmp_path / "test_cached.json"
+
+    with mock.patch.object(client, "_query") as query:
+        client.query(prompt="Women in peacekeeping", outputFile=str(outputFile))
+
+    query.assert_not_called()
+    with open(outputFile, "r") as f:
+        data = json.load(f)
+
+    assert data == client.query_cache["Women in peacekeeping"]
+
+
+def testFetchCache(tmp_path: Path) -> None:
+    """
+    Test that a response is fetched once, then served from the on-disk cache.
+    """
+    client = _cachedClient(tmp_path)
+    params = {"recid": "515307", "of": "xm"}
+
+    with mock.patch.object(
+        client.session, "get", return_value=_fakeResponse(SEARCH_RESPONSE)
+    ) as get:
+        assert client._fetch(consts.BASE_URL, params) == SEARCH_RESPONSE
+        assert client._fetch(consts.BASE_URL, params) == SEARCH_RESPONSE
+
+    get.assert_called_once()
+    assert client._cachePath(consts.BASE_URL, params).read_bytes() == SEARCH_RESPONSE
+
+    # Another request is a cache miss
+    with mock.patch.object(
+        client.session, "get", return_value=_fakeResponse(b"<collection/>")
+    ) as get:
+        assert client._fetch(consts.BASE_URL, {"recid": "1000"}) == b"<collection/>"
+
+    get.assert_called_once()
+
+
+def testFetchCacheExpiry(tmp_path: Path) -> None:
+    """
+    Test that a cached response older than its TTL is fetched again.
+    """
+    client = _cachedClient(tmp_path, cacheTtl=60)
+    params = {"p": "Women in peacekeeping"}
+
+    with mock.patch.object(
+        client.session, "get", return_value=_fakeResponse(SEARCH_RESPONSE)
+    ) as get:
+        client._fetch(consts.API_BASE_URL, params)
+
+        cachePath = client._cachePath(consts.API_BASE_URL, params)
+        expired = time.time() - 120
+        os.utime(cachePath, (expired, expired))
+
+        client._fetch(consts.API_BASE_URL, params)
+
+    assert get.call_count == 2
+
+
+def testFetchCacheErrors(tmp_path: Path) -> None:
+    """
+    Test that error responses are not cached, and that failing to write the
+    cache does not fail the request.
+    """
+    client = _cachedClient(tmp_path)
+    params = {"recid": "515307"}
+
+    with mock.patch.object(
+        client.session, "get", return_value=_fakeResponse(b"", statusCode=500)
+    ) as get:
+        client._fetch(consts.BASE_URL, params)
+        client._fetch(consts.BASE_URL, params)
+
+    assert get.call_count == 2
+    assert not list(tmp_path.iterdir())
+
+    # The cache directory vanished after the client was built
+    client.cache_dir = tmp_path / "missing"
+    with mock.patch.object(
+        client.session, "get", return_value=_fakeResponse(SEARCH_RESPONSE)
+    ):
+        assert client._fetch(consts.BASE_URL, params) == SEARCH_RESPONSE
+
+    assert not list(tmp_path.iterdir())
+
+
+def testDownloads() -> None:
+    """
+    Test that download links are paired with the label of their own 856
+    field, even when another 856 field has no label.
+    """
+    client = UNDLClient(useCache=False)
+    record = b"""<collection xmlns="http://www.loc.gov/MARC21/slim">
+  <record>
+    <controlfield tag="001">515307</controlfield>
+    <datafield tag="856" ind1="4" ind2=" ">
+      <subfield code="u">https://digitallibrary.un.org/record/515307/files/A_RES_70_1-AR.pdf</subfield>
+    </datafield>
+    <datafield tag="856" ind1="4" ind2=" ">
+      <subfield code="u">https://digitallibrary.un.org/record/515307/files/A_RES_70_1-EN.pdf</subfield>
+      <subfield code="y">English</subfield>
+    </datafield>
+  </record>
+</collection>
+"""
+
+    parsed = client.parseMARCXML(record)
+
+    assert parsed == client.parseMARCXML(record, usePymarc=True)
+    assert parsed["records"][0]["downloads"] == {
+        "English": "https://digitallibrary.un.org/record/515307/files/A_RES_70_1-EN.pdf"
+    }
+
+
 if __name__ == "__main__":
     import argparse
 